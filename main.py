@@ -1,9 +1,18 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import openai
+import httpx
+import asyncio
 import os
 import time
-from rapidfuzz import fuzz
+import json
+import hashlib
+import math
+import re
+import pickle
+import sqlite3
+from rapidfuzz import fuzz, process
 from io import BytesIO
 
 
@@ -18,6 +27,31 @@ st.set_page_config(
 with open('styles.css') as f:
     st.markdown(f'<style>{f.read()}</style>', unsafe_allow_html=True)
 
+CLASSIFICATION_MODEL = "gpt-4o-mini"  # Answers first; cheap and fast
+VERIFIER_MODEL = "gpt-4o"  # Re-answers when the classification model is unsure
+CONFIDENCE_THRESHOLD = 0.85  # Minimum probability of a tag's value to accept it without verification
+SYSTEM_PROMPT = "You are a precise academic text classifier."
+JSON_OVERHEAD_TOKENS = 6  # Tokens spent on quoting and separating one "tag": "category" field
+JSON_FIELD_PATTERN = re.compile(rb'"((?:[^"\\]|\\.)*)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+PROMPT_RULES = (
+    "\n\n"
+    "Rules:\n"
+    "1. For each tag, return ONLY the category name in lowercase\n"
+    "2. If no category fits a tag, return 'none' for it\n"
+    "3. Be precise and consistent\n"
+)
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_BATCH_SIZE = 1000  # The endpoint accepts up to 2048 inputs per request
+EMBEDDING_BATCH_TOKENS = 250000  # Stay under the 300k tokens-per-request cap
+SEMANTIC_SIMILARITY_THRESHOLD = 0.95
+FUZZY_MATCH_THRESHOLD = 90  # Minimum word-level ratio for a subtag to be taken as the answer
+FUZZY_RUNNER_UP_MAX = 70  # Every other subtag must score below this
+FUZZY_MIN_SUBTAG_LENGTH = 5  # Shorter subtags are too ambiguous to resolve locally
+NEGATION_WORDS = {"not", "no", "non", "without", "neither", "nor", "never", "lack", "lacks"}
+NEGATION_WINDOW = 3  # Words before a match in which a negation disqualifies it
+PROGRESS_UPDATE_INTERVAL = 0.25  # Minimum seconds between progress bar refreshes
+CACHE_DIR = os.path.expanduser("~/.iramuteq_tagger_cache")
+
 def get_openai_api_key():
     """
     Retrieve the OpenAI API key in the following order:
@@ -50,75 +84,762 @@ def get_openai_api_key():
 # Helper Functions
 # ------------------
 
-def validate_excel_file(df):
-    """Validate the uploaded Excel file structure."""
+def create_http_client():
+    """Create the HTTP/2 client used by the OpenAI client."""
+    return openai.DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=200, max_keepalive_connections=100),
+        timeout=httpx.Timeout(60.0, connect=10.0)
+    )
+
+def run_with_openai(api_key, job, **kwargs):
+    """Run `job` with a fresh OpenAI client, closing it before returning."""
+    async def run():
+        async with openai.AsyncOpenAI(api_key=api_key, http_client=create_http_client()) as openai_client:
+            return await job(openai_client=openai_client, **kwargs)
+    return asyncio.run(run())
+
+class RateLimiter:
+    """Token-bucket limiter for the OpenAI request and token quotas."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.max_requests_per_minute = requests_per_minute
+        self.max_tokens_per_minute = tokens_per_minute
+        self.available_request_capacity = requests_per_minute
+        self.available_token_capacity = tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60,
+            self.max_requests_per_minute
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60,
+            self.max_tokens_per_minute
+        )
+        self.last_update_time = now
+
+    async def acquire(self, estimated_tokens):
+        """Wait until one request and `estimated_tokens` tokens are available."""
+        estimated_tokens = min(estimated_tokens, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if (self.available_request_capacity >= 1
+                        and self.available_token_capacity >= estimated_tokens):
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= estimated_tokens
+                    return
+                # Sleep roughly until the scarcer bucket has refilled enough
+                request_wait = (1 - self.available_request_capacity) * 60 / self.max_requests_per_minute
+                token_wait = (estimated_tokens - self.available_token_capacity) * 60 / self.max_tokens_per_minute
+                await asyncio.sleep(max(request_wait, token_wait, 0.01))
+
+def validate_excel_header(header):
+    """Validate the uploaded Excel file structure from its column names."""
     required_columns = ['paper title', 'publication year', 'journal', 'abstract']
-    missing_columns = [col for col in required_columns if col not in df.columns]
+    missing_columns = [col for col in required_columns if col not in header]
     if missing_columns:
         raise ValueError(f"Missing required columns: {', '.join(missing_columns)}")
     return True
 
-def generate_py_tag(year):
-    """Generate publication year tag."""
-    try:
-        return f"*py_{int(year)}"
-    except (ValueError, TypeError):
-        st.warning(f"Invalid year format: {year}")
-        return "*py_unknown"
-
-def generate_jo_tag(journal):
-    """Generate journal tag."""
-    if not isinstance(journal, str):
-        return "*jo_unknown"
-    words = journal.strip().split()
-    return "*jo_" + ''.join(word[0].lower() for word in words if word)
-
-def generate_heading(row, custom_results):
-    """Generate the complete heading with all tags."""
-    heading = generate_py_tag(row['publication year']) + " " + generate_jo_tag(row['journal'])
+def generate_py_tags(years):
+    """Generate publication year tags for a whole column."""
+    numeric = pd.to_numeric(years, errors='coerce')
+    numeric = numeric.where(np.isfinite(numeric))
+    invalid = years[numeric.isna()]
+    if len(invalid):
+        st.warning(f"Invalid year format in {len(invalid)} row(s): {', '.join(map(str, invalid.unique()[:5]))}")
+    return ("*py_" + np.trunc(numeric).astype('Int64').astype(str)).where(numeric.notna(), "*py_unknown")
+
+def generate_jo_tags(journals):
+    """Generate journal tags (initials of each word) for a whole column."""
+    journals = journals.astype(object)
+    journals = journals.where(journals.map(type).eq(str))
+    initials = journals.str.findall(r'(?<!\S)\S').str.join('').str.lower()
+    return "*jo_" + initials.fillna("unknown")
+
+def generate_heading(base_tags, custom_results):
+    """Generate the complete heading from the year/journal tags and custom tags."""
+    heading = base_tags
     for res in custom_results:
         if res["value"]:
             heading += f" *{res['tag'].lower()}_{res['value'].lower()}"
     return heading
 
-def classify_custom_tag(objective, tag, subtags, definition, abstract, openai_client):
-    """Classify abstract using OpenAI API."""
-    if not abstract or not isinstance(abstract, str):
-        return ""
+def make_cache_key(model, objective, tag, subtags, definition, abstract):
+    """Build a stable key identifying a classification request."""
+    payload = json.dumps([model, objective, tag, list(subtags), definition, abstract])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def abstract_hash(abstract):
+    """Stable identifier of an abstract's text."""
+    return hashlib.sha256(abstract.encode('utf-8')).hexdigest()
+
+def make_tag_key(model, objective, tag, subtags, definition):
+    """Build a stable key identifying a tag configuration, independent of the abstract."""
+    payload = json.dumps([model, objective, tag, list(subtags), definition])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """Persistent key/value store for classification results, backed by SQLite."""
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL)")
+
+    def __contains__(self, key):
+        return self.conn.execute("SELECT 1 FROM cache WHERE key = ?", (key,)).fetchone() is not None
+
+    def __getitem__(self, key):
+        row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __setitem__(self, key, value):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+            (key, pickle.dumps(value))
+        )
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def values_with_prefix(self, prefix):
+        """Return the values of all keys starting with prefix."""
+        rows = self.conn.execute(
+            "SELECT value FROM cache WHERE key >= ? AND key < ?",
+            (prefix, prefix + "\uffff")
+        )
+        return [pickle.loads(value) for (value,) in rows]
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def open_result_cache():
+    """Open the persistent classification cache stored in CACHE_DIR."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return ResultCache(os.path.join(CACHE_DIR, "classifications.sqlite3"))
+
+class SemanticCache:
+    """Nearest-neighbour cache over L2-normalized abstract embeddings, per tag key."""
+
+    def __init__(self, store, threshold=SEMANTIC_SIMILARITY_THRESHOLD):
+        self.store = store
+        self.threshold = threshold
+        self._entries = {}  # tag key -> (list of embeddings, list of results)
+        self._matrices = {}  # tag key -> stacked embeddings, extended lazily
+
+    def _load(self, tag_key):
+        if tag_key not in self._entries:
+            rows = self.store.values_with_prefix(f"semantic:{tag_key}:")
+            self._entries[tag_key] = ([e for e, _ in rows], [r for _, r in rows])
+        return self._entries[tag_key]
+
+    def lookup(self, tag_key, embedding):
+        """Return the result of the most similar cached abstract, or None."""
+        embeddings, results = self._load(tag_key)
+        if not results:
+            return None
+        matrix = self._matrices.get(tag_key)
+        if matrix is None:
+            matrix = np.vstack(embeddings)
+        elif len(matrix) < len(embeddings):
+            matrix = np.vstack([matrix] + embeddings[len(matrix):])
+        self._matrices[tag_key] = matrix
+        if matrix.shape[1] != embedding.shape[0]:
+            return None
+        sims = matrix @ embedding
+        best = int(sims.argmax())
+        return results[best] if sims[best] >= self.threshold else None
 
-    # Convert tag and subtags to lowercase
-    tag = tag.lower()
-    subtags = [s.lower() for s in subtags]
+    def add(self, tag_key, abstract, embedding, result):
+        embeddings, results = self._load(tag_key)
+        embeddings.append(embedding)
+        results.append(result)
+        self.store[f"semantic:{tag_key}:{abstract_hash(abstract)}"] = (embedding, result)
 
-    prompt = (
-        f"Task: Classify the following academic abstract into one of these categories for tag '{tag}'.\n"
+async def embed_abstracts(abstracts, openai_client, semaphore, cache):
+    """
+    Return one L2-normalized embedding per abstract, reusing cached ones.
+    Invalid abstracts and failed batches yield None.
+    """
+    embeddings = [None] * len(abstracts)
+    positions = []
+    for i, abstract in enumerate(abstracts):
+        if not abstract or not isinstance(abstract, str):
+            continue
+        embeddings[i] = cache.get(f"embedding:{EMBEDDING_MODEL}:{abstract_hash(abstract)}")
+        if embeddings[i] is None:
+            positions.append(i)
+
+    async def embed_batch(batch_positions):
+        try:
+            async with semaphore:
+                response = await openai_client.embeddings.create(
+                    model=EMBEDDING_MODEL,
+                    input=[abstracts[i] for i in batch_positions]
+                )
+        except Exception as e:
+            st.warning(f"Embedding error: {str(e)}")
+            return
+        matrix = np.asarray(
+            [item.embedding for item in sorted(response.data, key=lambda item: item.index)],
+            dtype=np.float32
+        )
+        matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+        for i, embedding in zip(batch_positions, matrix):
+            embeddings[i] = embedding
+            cache[f"embedding:{EMBEDDING_MODEL}:{abstract_hash(abstracts[i])}"] = embedding
+
+    # Close a batch before it reaches either the input or the token limit
+    # (~3 characters per token keeps the estimate on the safe side)
+    batches, batch, batch_tokens = [], [], 0
+    for i in positions:
+        tokens = len(abstracts[i]) // 3 + 1
+        if batch and (len(batch) >= EMBEDDING_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_BATCH_TOKENS):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(i)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+
+    await asyncio.gather(*(embed_batch(batch_positions) for batch_positions in batches))
+    return embeddings
+
+def build_tag_section(tag, subtags, definition):
+    """Build the part of the classification prompt describing one tag."""
+    return (
+        f"Tag '{tag}':\n"
+        f"  Definition: {definition}\n"
+        f"  Available categories: {', '.join(subtags)}\n"
+    )
+
+def prepare_tags(objective, custom_tags):
+    """Normalize the custom tags and precompute their abstract-independent parts."""
+    prepared = []
+    for ct in custom_tags:
+        # Convert tag and subtags to lowercase
+        tag = ct['tag'].lower()
+        subtags = [s.lower() for s in ct['subtags']]
+        prepared.append({
+            "tag": tag,
+            "subtags": subtags,
+            "subtags_set": set(subtags),
+            "definition": ct['definition'],
+            "prompt_section": build_tag_section(tag, subtags, ct['definition']),
+            "enum": list(dict.fromkeys(subtags + ["none"])),
+            # Byte-level tokens never outnumber UTF-8 bytes, so this cannot truncate a valid answer
+            "max_tokens": JSON_OVERHEAD_TOKENS + len(tag.encode('utf-8'))
+                          + max(len(s.encode('utf-8')) for s in subtags + ["none"]),
+            "tag_key": make_tag_key(CLASSIFICATION_MODEL, objective, tag, subtags, ct['definition'])
+        })
+    return prepared
+
+def spec_cache_key(objective, spec, abstract):
+    """Result cache key of one (tag, abstract) pair."""
+    return make_cache_key(
+        CLASSIFICATION_MODEL, objective, spec['tag'], spec['subtags'], spec['definition'], abstract
+    )
+
+def build_classification_prompt(objective, specs, abstract):
+    """Build the user prompt asking to classify one abstract for all the given tags at once."""
+    return (
+        "Task: Classify the following academic abstract for each of these tags.\n"
         f"Context: The study objective is '{objective}'\n"
-        f"Tag definition: {definition}\n"
-        f"Available categories: {', '.join(subtags)}\n"
-        f"Abstract: {abstract}\n\n"
-        f"Rules:\n"
-        "1. Return ONLY the category name in lowercase\n"
-        "2. If no category fits, return 'none'\n"
-        "3. Be precise and consistent\n"
+        + "".join(spec['prompt_section'] for spec in specs)
+        + f"Abstract: {abstract}"
+        + PROMPT_RULES
     )
 
+def build_response_format(specs):
+    """Build a structured output schema with one field per tag, admitting only its subtags or 'none'."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "classification",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {
+                    spec['tag']: {"type": "string", "enum": spec['enum']} for spec in specs
+                },
+                "required": [spec['tag'] for spec in specs],
+                "additionalProperties": False
+            }
+        }
+    }
+
+def build_chat_request(prompt, specs, model):
+    """Build the chat completion parameters shared by synchronous and batch processing."""
+    return {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": 2 + sum(spec['max_tokens'] for spec in specs),
+        "temperature": 0,
+        "response_format": build_response_format(specs)
+    }
+
+def match_subtag_locally(abstract, spec):
+    """Return the subtag that unambiguously appears in the abstract, or None."""
+    words = re.findall(r"\w+", abstract.lower())
+    negated = [
+        any(w in NEGATION_WORDS for w in words[max(0, i - NEGATION_WINDOW):i])
+        for i in range(len(words))
+    ]
+    scores = np.zeros(len(spec['subtags']))
+    for i, subtag in enumerate(spec['subtags']):
+        n = len(re.findall(r"\w+", subtag))
+        candidates = [
+            " ".join(words[j:j + n]) for j in range(len(words) - n + 1) if not negated[j]
+        ]
+        if n and candidates:
+            scores[i] = process.cdist([subtag], candidates, scorer=fuzz.ratio).max()
+
+    best = int(scores.argmax())
+    runner_up = np.partition(scores, -2)[-2] if len(scores) > 1 else 0
+    if (len(spec['subtags'][best]) >= FUZZY_MIN_SUBTAG_LENGTH
+            and scores[best] >= FUZZY_MATCH_THRESHOLD
+            and runner_up < FUZZY_RUNNER_UP_MAX):
+        return spec['subtags'][best]
+    return None
+
+def tag_confidences(tokens, specs):
+    """Return {tag: probability of its value} from (token bytes, logprob) pairs."""
+    offsets = []
+    position = 0
+    for token, logprob in tokens:
+        offsets.append((position, position + len(token), logprob))
+        position += len(token)
+
+    spans = {}
+    for match in JSON_FIELD_PATTERN.finditer(b"".join(token for token, _ in tokens)):
+        try:
+            spans[json.loads(b'"' + match.group(1) + b'"')] = match.span(2)
+        except ValueError:
+            continue
+
+    confidences = {}
+    for spec in specs:
+        start, end = spans.get(spec['tag'], (0, 0))
+        value_logprobs = [logprob for first, last, logprob in offsets if first < end and last > start]
+        confidences[spec['tag']] = math.exp(sum(value_logprobs)) if value_logprobs else 0.0
+    return confidences
+
+def parse_classifications(content, specs):
+    """Extract each tag's category from a JSON model answer; invalid ones map to ''."""
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",  # Latest model as per blueprint
-            messages=[
-                {"role": "system", "content": "You are a precise academic text classifier."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=10,
-            temperature=0,
-            response_format={"type": "text"}
-        )
-        result = response.choices[0].message.content.strip().lower()
-        return result if result in subtags else ""
+        answer = json.loads(content)
+    except (TypeError, ValueError):
+        return {}
+    if not isinstance(answer, dict):
+        return {}
+    results = {}
+    for spec in specs:
+        if spec['tag'] in answer:
+            value = str(answer[spec['tag']]).strip().lower()
+            results[spec['tag']] = value if value in spec['subtags_set'] else ""
+    return results
+
+def resolve_locally(objective, specs, abstract, cache, fuzzy_match=False):
+    """
+    Resolve tags without the API.
+    Returns ({tag: value}, pending specs).
+    """
+    results = {spec['tag']: "" for spec in specs}
+    if not abstract or not isinstance(abstract, str):
+        return results, []
+
+    pending = []
+    for spec in specs:
+        # Skip the API when one subtag clearly appears in the abstract
+        if fuzzy_match:
+            local_match = match_subtag_locally(abstract, spec)
+            if local_match is not None:
+                results[spec['tag']] = local_match
+                continue
+        # Serve repeated requests from the local cache
+        cache_key = spec_cache_key(objective, spec, abstract)
+        if cache_key in cache:
+            results[spec['tag']] = cache[cache_key]
+        else:
+            pending.append(spec)
+    return results, pending
+
+async def classify_abstract(objective, pending, abstract, results, openai_client, semaphore,
+                            rate_limiter, cache, semantic_cache=None, embedding=None):
+    """Classify one abstract for its pending tags, filling them into results."""
+    use_semantic = semantic_cache is not None and embedding is not None
+
+    try:
+        async with semaphore:
+            # Reuse the classification of a near-duplicate abstract if one exists
+            if use_semantic:
+                remaining = []
+                for spec in pending:
+                    similar = semantic_cache.lookup(spec['tag_key'], embedding)
+                    if similar is not None:
+                        # Borrowed answers stay out of the exact cache, so the option can be turned off
+                        results[spec['tag']] = similar
+                    else:
+                        remaining.append(spec)
+                pending = remaining
+                if not pending:
+                    return results
+
+            prompt = build_classification_prompt(objective, pending, abstract)
+            request = build_chat_request(prompt, pending, CLASSIFICATION_MODEL)
+            estimated_tokens = len(prompt) // 4 + request['max_tokens']
+            await rate_limiter.acquire(estimated_tokens=estimated_tokens)
+            response = await openai_client.chat.completions.create(**request, logprobs=True)
+            choice = response.choices[0]
+            answers = parse_classifications(choice.message.content, pending)
+            tokens = [
+                (bytes(token.bytes) if token.bytes else token.token.encode('utf-8'), token.logprob)
+                for token in (choice.logprobs.content or [] if choice.logprobs else [])
+            ]
+            confidences = tag_confidences(tokens, pending)
+            # Let the larger model re-answer only the tags the small one is unsure of
+            unsure = [spec for spec in pending if confidences[spec['tag']] < CONFIDENCE_THRESHOLD]
+            if unsure:
+                for spec in unsure:
+                    answers.pop(spec['tag'], None)
+                verify_prompt = build_classification_prompt(objective, unsure, abstract)
+                verify_request = build_chat_request(verify_prompt, unsure, VERIFIER_MODEL)
+                await rate_limiter.acquire(
+                    estimated_tokens=len(verify_prompt) // 4 + verify_request['max_tokens']
+                )
+                response = await openai_client.chat.completions.create(**verify_request)
+                answers.update(parse_classifications(response.choices[0].message.content, unsure))
+        for spec in pending:
+            if spec['tag'] not in answers:
+                continue
+            result = answers[spec['tag']]
+            results[spec['tag']] = result
+            cache[spec_cache_key(objective, spec, abstract)] = result
+            if use_semantic:
+                semantic_cache.add(spec['tag_key'], abstract, embedding, result)
+        return results
+    except Exception as e:
+        st.error(f"Classification error: {str(e)}")
+        await asyncio.sleep(1)  # Rate limiting protection
+        return results
+
+async def classify_all(abstracts, objective, custom_tags, openai_client, max_concurrency,
+                       requests_per_minute, tokens_per_minute, use_semantic_cache=False,
+                       use_fuzzy_match=False, on_progress=None):
+    """
+    Classify every distinct abstract concurrently.
+    Returns one {tag: value} dict per abstract, in input order.
+    """
+    tag_specs = prepare_tags(objective, custom_tags)
+    # Classify each distinct abstract once
+    unique_abstracts = list(dict.fromkeys(abstracts))
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    total = len(unique_abstracts)
+    done = 0
+    last_update = 0.0
+
+    async def run(abstract, results, pending, embedding, cache, semantic_cache):
+        nonlocal done, last_update
+        if pending:
+            results = await classify_abstract(
+                objective,
+                pending,
+                abstract,
+                results,
+                openai_client,
+                semaphore,
+                rate_limiter,
+                cache,
+                semantic_cache,
+                embedding
+            )
+        done += 1
+        # Each progress update is a round-trip to the browser, so throttle them
+        now = time.monotonic()
+        if on_progress and (done == total or now - last_update >= PROGRESS_UPDATE_INTERVAL):
+            last_update = now
+            on_progress(done, total)
+        return results
+
+    with open_result_cache() as cache:
+        resolved = [
+            resolve_locally(objective, tag_specs, abstract, cache, use_fuzzy_match)
+            for abstract in unique_abstracts
+        ]
+
+        # Embed each abstract that still needs the API once; the embedding is shared by all tags
+        embeddings = [None] * len(unique_abstracts)
+        if use_semantic_cache:
+            needs_api = [i for i, (_, pending) in enumerate(resolved) if pending]
+            for i, embedding in zip(needs_api, await embed_abstracts(
+                [unique_abstracts[i] for i in needs_api], openai_client, semaphore, cache
+            )):
+                embeddings[i] = embedding
+
+        semantic_cache = SemanticCache(cache) if use_semantic_cache else None
+        tasks = [
+            run(abstract, results, pending, embedding, cache, semantic_cache)
+            for abstract, (results, pending), embedding in zip(unique_abstracts, resolved, embeddings)
+        ]
+        values = await asyncio.gather(*tasks)
+
+    by_abstract = dict(zip(unique_abstracts, values))
+    return [by_abstract[abstract] for abstract in abstracts]
+
+def build_batch_file(abstracts, objective, custom_tags, cache, use_fuzzy_match=False):
+    """Build the Batch API JSONL input for every abstract with pending tags."""
+    tag_specs = prepare_tags(objective, custom_tags)
+    lines = []
+    for abstract in dict.fromkeys(abstracts):
+        if not abstract or not isinstance(abstract, str):
+            continue
+        pending = [
+            spec for spec in tag_specs
+            if spec_cache_key(objective, spec, abstract) not in cache
+            and not (use_fuzzy_match and match_subtag_locally(abstract, spec) is not None)
+        ]
+        if not pending:
+            continue
+        lines.append(build_batch_line(objective, pending, abstract, CLASSIFICATION_MODEL))
+    return "\n".join(lines).encode('utf-8')
+
+def build_batch_line(objective, specs, abstract, model):
+    """Build one JSONL request of a batch input file."""
+    body = build_chat_request(build_classification_prompt(objective, specs, abstract), specs, model)
+    if model == CLASSIFICATION_MODEL:
+        body["logprobs"] = True
+    return json.dumps({
+        "custom_id": abstract_hash(abstract),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": body
+    })
+
+async def create_batch(openai_client, batch_file, stage):
+    """Upload a batch input file and create its job, tagged with the pipeline stage."""
+    input_file = await openai_client.files.create(
+        file=("iramuteq_batch.jsonl", batch_file),
+        purpose="batch"
+    )
+    batch = await openai_client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={"stage": stage}
+    )
+    return batch.id
+
+async def submit_batch(abstracts, objective, custom_tags, openai_client, use_fuzzy_match=False):
+    """
+    Upload the pending requests and create a batch job.
+    Returns the batch ID, or None when every pair is already cached.
+    """
+    with open_result_cache() as cache:
+        batch_file = build_batch_file(abstracts, objective, custom_tags, cache, use_fuzzy_match)
+    if not batch_file:
+        return None
+    return await create_batch(openai_client, batch_file, "classify")
+
+async def fetch_batch_results(batch_id, abstracts, objective, custom_tags, openai_client,
+                              use_fuzzy_match=False):
+    """
+    Retrieve a batch job and cache its answers.
+    Returns (batch, results or None, errors, verify_batch_id or None).
+    """
+    answers = {}
+    errors = []
+
+    async def read_batch_file(file_id):
+        content = await openai_client.files.content(file_id)
+        for line in content.text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") == 200:
+                answers[item["custom_id"]] = response["body"]["choices"][0]
+            else:
+                error = item.get("error") or (response.get("body") or {}).get("error") or {}
+                errors.append(
+                    f"{item.get('custom_id')}: {error.get('message') or 'status ' + str(response.get('status_code'))}"
+                )
+
+    if batch_id:
+        batch = await openai_client.batches.retrieve(batch_id)
+        if batch.status == "failed" and batch.errors:
+            errors.extend(error.message for error in batch.errors.data or [])
+        if batch.status != "completed":
+            return batch, None, errors, None
+        if batch.output_file_id:
+            await read_batch_file(batch.output_file_id)
+        if batch.error_file_id:
+            await read_batch_file(batch.error_file_id)
+        if not batch.output_file_id:
+            errors.insert(0, "The batch completed without an output file")
+            return batch, None, errors, None
+    else:
+        batch = None
+    verifying = batch is not None and (batch.metadata or {}).get("stage") == "verify"
+
+    tag_specs = prepare_tags(objective, custom_tags)
+    by_abstract = {}
+    verify_lines = []
+    with open_result_cache() as cache:
+        for abstract in dict.fromkeys(abstracts):
+            row_results = {spec['tag']: "" for spec in tag_specs}
+            by_abstract[abstract] = row_results
+            if not abstract or not isinstance(abstract, str):
+                continue
+            choice = answers.get(abstract_hash(abstract))
+            parsed = parse_classifications(choice["message"]["content"] if choice else None, tag_specs)
+            if parsed and not verifying:
+                tokens = [
+                    (bytes(token["bytes"]) if token.get("bytes") else token["token"].encode('utf-8'),
+                     token["logprob"])
+                    for token in (choice.get("logprobs") or {}).get("content") or []
+                ]
+                confidences = tag_confidences(tokens, tag_specs)
+                # Leave unsure tags to the verifier batch instead of caching them
+                unsure = [
+                    spec for spec in tag_specs
+                    if spec['tag'] in parsed and confidences[spec['tag']] < CONFIDENCE_THRESHOLD
+                ]
+                for spec in unsure:
+                    del parsed[spec['tag']]
+                unverified = [
+                    spec for spec in unsure
+                    if spec_cache_key(objective, spec, abstract) not in cache
+                ]
+                if unverified:
+                    verify_lines.append(build_batch_line(objective, unverified, abstract, VERIFIER_MODEL))
+            for spec in tag_specs:
+                if use_fuzzy_match:
+                    local_match = match_subtag_locally(abstract, spec)
+                    if local_match is not None:
+                        row_results[spec['tag']] = local_match
+                        continue
+                cache_key = spec_cache_key(objective, spec, abstract)
+                if spec['tag'] in parsed:
+                    cache[cache_key] = parsed[spec['tag']]
+                row_results[spec['tag']] = cache.get(cache_key, "")
+        if verify_lines:
+            verify_batch_id = cache.get(f"verify_batch:{batch_id}")
+            if verify_batch_id is None:
+                verify_batch_id = await create_batch(
+                    openai_client, "\n".join(verify_lines).encode('utf-8'), "verify"
+                )
+                cache[f"verify_batch:{batch_id}"] = verify_batch_id
+            return batch, None, errors, verify_batch_id
+    return batch, [by_abstract[abstract] for abstract in abstracts], errors, None
+
+@st.cache_data(show_spinner="Reading Excel file...")
+def load_excel(file_bytes):
+    """Read and validate the uploaded Excel file, cached by its content."""
+    df = pd.read_excel(BytesIO(file_bytes), engine='calamine')
+    validate_excel_header(df.columns)
+    return df
+
+def show_results(df, custom_tags, all_results):
+    """Add the classifications and headings to df and offer the output files for download."""
+    # Year and journal tags are computed once for the whole frame
+    base_tags = (generate_py_tags(df['publication year']) + " " + generate_jo_tags(df['journal'])).tolist()
+
+    # Process each abstract, collecting plain lists and assigning whole columns at the end
+    tag_columns = {ct['tag']: [] for ct in custom_tags}
+    final_headings = []
+    for base_tag, row_results in zip(base_tags, all_results):
+        ct_results = []
+        for ct in custom_tags:
+            chosen = row_results[ct['tag']]
+            tag_columns[ct['tag']].append(chosen)
+            ct_results.append({"tag": ct['tag'], "value": chosen})
+
+        final_heading = generate_heading(base_tag, ct_results)
+        final_headings.append(final_heading)
+
+    for tag, column in tag_columns.items():
+        df[tag] = column
+    df["final_heading"] = final_headings
+
+    # Prepare output files
+    try:
+        # Create Excel output
+        excel_buffer = BytesIO()
+        with pd.ExcelWriter(excel_buffer, engine='xlsxwriter') as writer:
+            df.to_excel(writer, index=False, sheet_name='Classified Abstracts')
+        excel_data = excel_buffer.getvalue()
+
+        # Create Parquet output, a compact alternative for large result sets
+        parquet_data = None
+        try:
+            parquet_buffer = BytesIO()
+            # Bibliographic exports mix numbers and text in one column, which Parquet rejects
+            df.astype({col: "string" for col in df.columns[df.dtypes == object]}).to_parquet(
+                parquet_buffer, index=False, compression='zstd'
+            )
+            parquet_data = parquet_buffer.getvalue()
+        except Exception as e:
+            st.warning(f"Parquet output unavailable: {str(e)}")
+
+        # Create text output, encoding each record straight into the buffer
+        txt_buffer = BytesIO()
+        txt_buffer.write(b"****")
+        for heading, abstract in zip(final_headings, df['abstract'].tolist()):
+            txt_buffer.write(f"\n{heading}\n{abstract}\n****".encode('utf-8'))
+        txt_output = txt_buffer.getvalue()
+
+        # Download buttons
+        col1, col2, col3 = st.columns(3)
+        with col1:
+            st.download_button(
+                "📥 Download Excel Results",
+                excel_data,
+                file_name="classified_abstracts.xlsx",
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
+        with col2:
+            st.download_button(
+                "📥 Download Iramuteq Text",
+                txt_output,
+                file_name="iramuteq_output.txt",
+                mime="text/plain"
+            )
+        with col3:
+            st.download_button(
+                "📥 Download Parquet Results",
+                parquet_data or b"",
+                file_name="classified_abstracts.parquet",
+                mime="application/vnd.apache.parquet",
+                disabled=parquet_data is None
+            )
+
+        st.success("✅ Processing complete! Download your results above.")
+
     except Exception as e:
-        st.error(f"Classification error for tag '{tag}': {str(e)}")
-        time.sleep(1)  # Rate limiting protection
-        return ""
+        st.error(f"❌ Error during file generation: {str(e)}")
+        st.stop()
 
 # ------------------
 # Main Application
@@ -141,15 +862,9 @@ def main():
             key="openai_api_key"
         )
 
-    # Initialize OpenAI client if we have the key
-    openai_client = None
+    # The OpenAI client is created per job by run_with_openai
     if api_key:
-        try:
-            openai_client = openai.OpenAI(api_key=api_key)
-            st.success("✅ OpenAI API key configured successfully!")
-        except Exception as e:
-            st.error(f"Failed to initialize OpenAI client: {str(e)}")
-            api_key = None
+        st.success("✅ OpenAI API key configured successfully!")
 
     # File upload section
     with st.container():
@@ -215,87 +930,179 @@ def main():
                             "value": ""
                         })
 
+    # Performance settings section
+    with st.container():
+        st.subheader("⚙️ Performance Settings")
+        max_concurrency = st.slider(
+            "Max concurrent API requests",
+            min_value=1,
+            max_value=50,
+            value=10,
+            help="Number of classification requests sent to OpenAI in parallel",
+            disabled=not api_key
+        )
+        col1, col2 = st.columns(2)
+        with col1:
+            requests_per_minute = st.number_input(
+                "Requests per minute (RPM)",
+                min_value=1,
+                value=500,
+                step=50,
+                help="Request rate limit of your OpenAI account tier",
+                disabled=not api_key
+            )
+        with col2:
+            tokens_per_minute = st.number_input(
+                "Tokens per minute (TPM)",
+                min_value=1000,
+                value=30000,
+                step=1000,
+                help="Token rate limit of your OpenAI account tier",
+                disabled=not api_key
+            )
+        use_semantic_cache = st.checkbox(
+            "Reuse results for near-duplicate abstracts",
+            value=False,
+            help=(
+                "Embeds each abstract and reuses the classification of a previously classified "
+                f"abstract with cosine similarity of at least {SEMANTIC_SIMILARITY_THRESHOLD}"
+            ),
+            disabled=not api_key
+        )
+        use_fuzzy_match = st.checkbox(
+            "Resolve obvious matches without the API",
+            value=False,
+            help=(
+                "When exactly one subtag appears as whole words in an abstract (fuzzy match score "
+                f"of at least {FUZZY_MATCH_THRESHOLD}, not preceded by a negation), use it directly "
+                "instead of asking OpenAI. Subtags shorter than "
+                f"{FUZZY_MIN_SUBTAG_LENGTH} characters are always sent to OpenAI."
+            ),
+            disabled=not api_key
+        )
+
     # Show warning if API key is missing
     if not api_key:
         st.warning("⚠️ Please enter your OpenAI API key above to enable abstract classification.")
         st.stop()
 
     # Processing section
-    if st.button("Process Abstracts", disabled=not (uploaded_file and objective and custom_tags)):
-        try:
-            with st.spinner("Reading Excel file..."):
-                df = pd.read_excel(uploaded_file, engine='openpyxl')
-                validate_excel_file(df)
-
-            # Initialize progress
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-
-            # Process each abstract
-            final_headings = []
-            for idx, row in df.iterrows():
-                progress = (idx + 1) / len(df)
-                progress_bar.progress(progress)
-                status_text.text(f"Processing abstract {idx + 1} of {len(df)}...")
-
-                ct_results = []
-                for ct in custom_tags:
-                    chosen = classify_custom_tag(
-                        objective,
-                        ct['tag'],
-                        ct['subtags'],
-                        ct['definition'],
-                        row['abstract'],
-                        openai_client
-                    )
-                    df.at[idx, ct['tag']] = chosen
-                    ct_results.append({"tag": ct['tag'], "value": chosen})
+    can_process = bool(uploaded_file and objective and custom_tags)
+    processing_mode = st.radio(
+        "Processing mode",
+        ["Synchronous", "Batch"],
+        horizontal=True,
+        help=(
+            "Synchronous classifies abstracts immediately. Batch submits them to the OpenAI "
+            "Batch API at half the cost, with results available within 24 hours; unsure "
+            "answers go to a second, smaller verification batch."
+        )
+    )
 
-                final_heading = generate_heading(row, ct_results)
-                final_headings.append(final_heading)
+    if processing_mode == "Synchronous":
+        if st.button("Process Abstracts", disabled=not can_process):
+            try:
+                df = load_excel(uploaded_file.getvalue())
 
-            df["final_heading"] = final_headings
+                # Initialize progress
+                progress_bar = st.progress(0)
+                status_text = st.empty()
 
-            # Prepare output files
-            try:
-                # Create Excel output
-                excel_buffer = BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                    df.to_excel(writer, index=False, sheet_name='Classified Abstracts')
-                excel_data = excel_buffer.getvalue()
-
-                # Create text output
-                txt_output = "****\n" + "\n****\n".join(
-                    f"{heading}\n{abstract}" for heading, abstract in
-                    zip(final_headings, df['abstract'])
-                ) + "\n****"
-
-                # Download buttons
-                col1, col2 = st.columns(2)
-                with col1:
-                    st.download_button(
-                        "📥 Download Excel Results",
-                        excel_data,
-                        file_name="classified_abstracts.xlsx",
-                        mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                    )
-                with col2:
-                    st.download_button(
-                        "📥 Download Iramuteq Text",
-                        txt_output,
-                        file_name="iramuteq_output.txt",
-                        mime="text/plain"
-                    )
+                def on_progress(done, total):
+                    progress_bar.progress(done / total)
+                    status_text.text(f"Classified {done} of {total} abstracts...")
+
+                # Classify all abstracts concurrently
+                all_results = run_with_openai(
+                    api_key,
+                    classify_all,
+                    abstracts=df['abstract'].tolist(),
+                    objective=objective,
+                    custom_tags=custom_tags,
+                    max_concurrency=max_concurrency,
+                    requests_per_minute=requests_per_minute,
+                    tokens_per_minute=tokens_per_minute,
+                    use_semantic_cache=use_semantic_cache,
+                    use_fuzzy_match=use_fuzzy_match,
+                    on_progress=on_progress
+                )
 
-                st.success("✅ Processing complete! Download your results above.")
+                show_results(df, custom_tags, all_results)
 
             except Exception as e:
-                st.error(f"❌ Error during file generation: {str(e)}")
+                st.error(f"❌ Error during processing: {str(e)}")
+                st.stop()
+    else:
+        st.info(
+            "Submit the job, then come back later with the same file, objective and tags "
+            "to collect the results using the batch ID below."
+        )
+        if st.button("Submit Batch Job", disabled=not can_process):
+            try:
+                df = load_excel(uploaded_file.getvalue())
+                with st.spinner("Submitting batch job..."):
+                    batch_id = run_with_openai(
+                        api_key,
+                        submit_batch,
+                        abstracts=df['abstract'].tolist(),
+                        objective=objective,
+                        custom_tags=custom_tags,
+                        use_fuzzy_match=use_fuzzy_match
+                    )
+                if batch_id:
+                    st.session_state["batch_id"] = batch_id
+                    st.success(f"✅ Batch job submitted with ID {batch_id}")
+                else:
+                    st.session_state["batch_id"] = ""
+                    st.success("✅ All abstracts are already cached. Click 'Check Batch Status' to download.")
+            except Exception as e:
+                st.error(f"❌ Error during batch submission: {str(e)}")
                 st.stop()
 
-        except Exception as e:
-            st.error(f"❌ Error during processing: {str(e)}")
-            st.stop()
+        # A verification batch ID can only be placed in the field before it is drawn
+        if "next_batch_id" in st.session_state:
+            st.session_state["batch_id"] = st.session_state.pop("next_batch_id")
+        batch_id = st.text_input(
+            "Batch job ID",
+            key="batch_id",
+            help="ID of a previously submitted batch job"
+        )
+        if st.button("Check Batch Status", disabled=not can_process):
+            try:
+                df = load_excel(uploaded_file.getvalue())
+                with st.spinner("Retrieving batch job..."):
+                    batch, all_results, errors, verify_batch_id = run_with_openai(
+                        api_key,
+                        fetch_batch_results,
+                        batch_id=batch_id.strip(),
+                        abstracts=df['abstract'].tolist(),
+                        objective=objective,
+                        custom_tags=custom_tags,
+                        use_fuzzy_match=use_fuzzy_match
+                    )
+                if batch is not None:
+                    counts = batch.request_counts
+                    st.info(
+                        f"Batch status: {batch.status}"
+                        + (f" ({counts.completed} of {counts.total} requests done)" if counts else "")
+                    )
+                if errors:
+                    report = st.error if all_results is None else st.warning
+                    report(
+                        f"❌ {len(errors)} batch request(s) failed:\n"
+                        + "\n".join(f"- {error}" for error in errors[:10])
+                    )
+                if verify_batch_id:
+                    st.session_state["next_batch_id"] = verify_batch_id
+                    st.success(
+                        f"✅ Low-confidence answers were resubmitted to {VERIFIER_MODEL} as batch "
+                        f"{verify_batch_id}. Check that batch later to download the results."
+                    )
+                if all_results is not None:
+                    show_results(df, custom_tags, all_results)
+            except Exception as e:
+                st.error(f"❌ Error during batch retrieval: {str(e)}")
+                st.stop()
 
 if __name__ == "__main__":
     main()